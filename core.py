@@ -0,0 +1,735 @@
+"""Per-message hot path: database access, OG scraping, link handling and RSS rendering.
+
+Kept free of web framework code so it can be compiled with mypyc; main.py imports the
+compiled extension when present and this source otherwise.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape, quoteattr
+
+import httpx
+from selectolax.lexbor import LexborHTMLParser
+from telegram import Update
+from telegram.ext import ContextTypes
+
+
+@dataclass
+class OGData:
+    """Open Graph metadata"""
+
+    title: str | None = None
+    description: str | None = None
+    image: str | None = None
+
+
+@dataclass
+class RssFeed:
+    """Rendered RSS feed with its cache validators"""
+
+    xml: bytes
+    gzip: bytes
+    etag: str
+    last_modified: int | None = None
+
+
+@dataclass
+class LinkData:
+    """Link data with metadata"""
+
+    url: str
+    title: str
+    description: str
+    date: int  # Unix epoch seconds
+    image: str | None = None
+    message_id: int | None = None
+
+
+# Configuration
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8080"))
+APP_URL = os.getenv("APP_URL", f"http://localhost:{HTTP_PORT}")
+DB_PATH = os.getenv("DB_PATH", "links.local.db")
+
+# Database connection, used for all writes
+db_conn: sqlite3.Connection | None = None
+
+# Serializes writes in the app instead of leaving contention to SQLite's busy handler
+db_write_lock = asyncio.Lock()
+
+# How often to run PRAGMA optimize and checkpoint the WAL (1 hour)
+DB_OPTIMIZE_INTERVAL = 60 * 60
+
+# Queries run on every request, kept as constants so each connection's statement cache reuses them
+SQL_SELECT_TOKEN = "SELECT token FROM groups WHERE chat_id = ?"
+SQL_INSERT_GROUP = "INSERT INTO groups (chat_id, token) VALUES (?, ?)"
+SQL_SELECT_CHAT_BY_TOKEN = "SELECT chat_id FROM groups WHERE token = ?"
+SQL_UPSERT_LINK = """
+    INSERT INTO links (chat_id, url, title, description, image, message_id, date)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id, message_id, url) DO UPDATE SET
+        title = excluded.title,
+        description = excluded.description,
+        image = excluded.image
+    WHERE links.title IS NOT excluded.title
+        OR links.description IS NOT excluded.description
+        OR links.image IS NOT excluded.image
+"""
+SQL_SELECT_LINKS = """
+    SELECT url, title, description, image, message_id, date FROM links
+    WHERE chat_id = ? ORDER BY date DESC LIMIT ?
+"""
+SQL_DELETE_STALE_LINKS = """
+    DELETE FROM links
+    WHERE chat_id = ? AND message_id = ? AND url NOT IN (SELECT value FROM json_each(?))
+"""
+SQL_SELECT_OG_CACHE = "SELECT title, description, image, fetched_at FROM og_cache WHERE url = ?"
+SQL_UPSERT_OG_CACHE = """
+    INSERT INTO og_cache (url, title, description, image, fetched_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(url) DO UPDATE SET
+        title = excluded.title,
+        description = excluded.description,
+        image = excluded.image,
+        fetched_at = excluded.fetched_at
+"""
+SQL_DELETE_EXPIRED_OG_CACHE = "DELETE FROM og_cache WHERE fetched_at < ?"
+
+# Pool of read-only connections, so WAL readers don't queue behind the writer
+READ_POOL_SIZE = 6
+read_pool: queue.Queue[sqlite3.Connection] = queue.Queue()
+# Every connection opened for the pool, so they can be closed on shutdown
+read_conns: list[sqlite3.Connection] = []
+read_conns_lock = threading.Lock()
+
+# Shared HTTP client for scraping, reused across messages to keep connections alive
+http_client: httpx.AsyncClient | None = None
+
+# Recently scraped OG tags: url -> (og_data, fetched_at), most recently used last
+og_cache: OrderedDict[str, tuple[OGData, float]] = OrderedDict()
+OG_CACHE_SIZE = 1024
+OG_CACHE_TTL = 24 * 60 * 60
+
+# Bound concurrent page fetches, overall and per remote host
+og_fetch_semaphore = asyncio.Semaphore(16)
+og_host_semaphores: dict[str, asyncio.Semaphore] = {}
+# Fetches holding or waiting on each host's semaphore, so idle hosts can be dropped
+og_host_users: dict[str, int] = {}
+
+# OG tags live in <head>, so stop downloading pages after it (or after this many bytes)
+OG_HEAD_MAX_BYTES = 64 * 1024
+
+# Rendered RSS feeds per chat, invalidated whenever the chat's links change
+rss_cache: dict[str, RssFeed] = {}
+rss_versions: dict[str, int] = {}
+# Time each chat's links last changed, served as Last-Modified
+rss_modified: dict[str, int] = {}
+rss_version_counter = itertools.count(1)
+# Writes invalidate from a worker thread, so caching a render must not interleave with them
+rss_cache_lock = threading.Lock()
+
+# RSS feed templates
+RSS_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S +0000"
+RSS_HEADER_TEMPLATE = (
+    '<rss version="2.0"><channel>'
+    "<title>Telegram Group Links</title>"
+    "<link>{link}</link>"
+    "<description>Links shared in Telegram group</description>"
+    "<lastBuildDate>{build_date}</lastBuildDate>"
+)
+RSS_ITEM_TEMPLATE = (
+    "<item>"
+    "<title>{title}</title>"
+    "<link>{url}</link>"
+    "<description>{description}</description>"
+    "<pubDate>{pub_date}</pubDate>"
+    "<guid>{guid}</guid>"
+    "{enclosure}"
+    "</item>"
+)
+RSS_FOOTER = "</channel></rss>"
+
+# URL regex pattern
+URL_PATTERN = re.compile(r"https?://[^\s<>\"']+")
+
+
+def connect_database() -> sqlite3.Connection:
+    """Open a SQLite connection with the shared pragmas"""
+    # Use timeout for concurrent access
+    conn = sqlite3.connect(DB_PATH, timeout=10.0, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    # Set busy timeout for concurrent access (5 seconds)
+    cursor.execute("PRAGMA busy_timeout=5000")
+
+    # Balance between safety and performance
+    cursor.execute("PRAGMA synchronous=NORMAL")
+
+    # Increase cache size for better performance
+    cursor.execute("PRAGMA cache_size=-64000")
+
+    # Enable foreign keys
+    cursor.execute("PRAGMA foreign_keys=ON")
+
+    # Checkpoint the WAL every ~1000 pages so it doesn't keep growing
+    cursor.execute("PRAGMA wal_autocheckpoint=1000")
+
+    # Memory-map up to 256 MB of the database for faster reads
+    cursor.execute("PRAGMA mmap_size=268435456")
+
+    # Keep temporary tables and indices in memory
+    cursor.execute("PRAGMA temp_store=MEMORY")
+
+    return conn
+
+
+def init_database() -> None:
+    """Initialize SQLite database"""
+    global db_conn
+    db_conn = connect_database()
+    cursor = db_conn.cursor()
+
+    # Larger pages, only applies to a new database so it must come before WAL mode and the tables
+    cursor.execute("PRAGMA page_size=8192")
+
+    # Enable WAL mode for better concurrent access
+    cursor.execute("PRAGMA journal_mode=WAL")
+
+    # Create groups table
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS groups (
+            chat_id TEXT PRIMARY KEY,
+            token TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+    # Create links table
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS links (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            title TEXT,
+            description TEXT,
+            image TEXT,
+            message_id INTEGER,
+            date INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            FOREIGN KEY (chat_id) REFERENCES groups(chat_id)
+        )
+        """
+    )
+
+    # Migrate dates stored as ISO timestamps by older versions to epoch seconds
+    cursor.execute("UPDATE links SET date = CAST(strftime('%s', date) AS INTEGER) WHERE typeof(date) = 'text'")
+
+    # Drop the unused change time column added by older versions
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(links)")]
+    if "updated_at" in columns:
+        cursor.execute("ALTER TABLE links DROP COLUMN updated_at")
+
+    # Index the per-group feed query
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_links_chat_date ON links(chat_id, date DESC)")
+
+    # Each URL is stored once per message, so edits can upsert instead of delete and re-insert
+    has_unique_index = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_links_chat_msg_url'"
+    ).fetchone()
+    if not has_unique_index:
+        cursor.execute("DELETE FROM links WHERE id NOT IN (SELECT MIN(id) FROM links GROUP BY chat_id, message_id, url)")
+        cursor.execute("CREATE UNIQUE INDEX idx_links_chat_msg_url ON links(chat_id, message_id, url)")
+
+    # Superseded by the unique index above, which covers the same prefix
+    cursor.execute("DROP INDEX IF EXISTS idx_links_chat_msg")
+
+    # Create OG tags cache table
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS og_cache (
+            url TEXT PRIMARY KEY,
+            title TEXT,
+            description TEXT,
+            image TEXT,
+            fetched_at REAL NOT NULL
+        )
+        """
+    )
+
+    db_conn.commit()
+
+
+@contextmanager
+def read_connection() -> Iterator[sqlite3.Connection | None]:
+    """Check out a read-only connection from the pool, opening one while below READ_POOL_SIZE"""
+    if not db_conn:
+        yield None
+        return
+
+    try:
+        conn = read_pool.get_nowait()
+    except queue.Empty:
+        with read_conns_lock:
+            can_open = len(read_conns) < READ_POOL_SIZE
+            if can_open:
+                conn = connect_database()
+                conn.execute("PRAGMA query_only=ON")
+                read_conns.append(conn)
+
+        # Pool is full, wait for another request to return its connection
+        if not can_open:
+            conn = read_pool.get()
+
+    try:
+        yield conn
+    finally:
+        read_pool.put(conn)
+
+
+def optimize_database() -> None:
+    """Prune expired OG tags, refresh query planner statistics and truncate the WAL"""
+    if not db_conn:
+        return
+
+    db_conn.execute(SQL_DELETE_EXPIRED_OG_CACHE, (time.time() - OG_CACHE_TTL,))
+    db_conn.commit()
+
+    db_conn.execute("PRAGMA optimize")
+    db_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def close_database() -> None:
+    """Close the writer and all read connections"""
+    with read_conns_lock:
+        for conn in read_conns:
+            conn.close()
+        read_conns.clear()
+
+        while not read_pool.empty():
+            read_pool.get_nowait()
+
+    if db_conn:
+        db_conn.close()
+
+
+async def run_db_write[T](func: Callable[..., T], *args: object) -> T:
+    """Run a blocking database write in a worker thread, one writer at a time"""
+    async with db_write_lock:
+        return await asyncio.to_thread(func, *args)
+
+
+async def periodic_optimize() -> None:
+    """Optimize the database every DB_OPTIMIZE_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_INTERVAL)
+        try:
+            await run_db_write(optimize_database)
+        except sqlite3.Error as e:
+            print(f"Error optimizing database: {e}")
+
+
+def get_group_token(chat_id: int | str) -> str:
+    """Get or create token for a group"""
+    if not db_conn:
+        return ""
+
+    chat_id_str = str(chat_id)
+
+    # Check if group exists
+    result = db_conn.execute(SQL_SELECT_TOKEN, (chat_id_str,)).fetchone()
+
+    if result:
+        return result[0]
+
+    # Create new token for group
+    token = str(uuid.uuid4())
+    db_conn.execute(SQL_INSERT_GROUP, (chat_id_str, token))
+    db_conn.commit()
+
+    return token
+
+
+def save_message_links(chat_id: int | str, message_id: int, links_list: list[LinkData]) -> None:
+    """Sync the stored links of a message with links_list in a single transaction"""
+    if not db_conn:
+        return
+
+    chat_id_str = str(chat_id)
+    changes_before = db_conn.total_changes
+
+    db_conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Insert new links and update changed ones, unchanged rows are left alone
+        db_conn.executemany(
+            SQL_UPSERT_LINK,
+            [
+                (
+                    chat_id_str,
+                    link_data.url,
+                    link_data.title,
+                    link_data.description,
+                    link_data.image,
+                    message_id,
+                    link_data.date,
+                )
+                for link_data in links_list
+            ],
+        )
+
+        # Drop links removed from the message by an edit
+        urls = json.dumps([link_data.url for link_data in links_list])
+        db_conn.execute(SQL_DELETE_STALE_LINKS, (chat_id_str, message_id, urls))
+    except Exception:
+        db_conn.rollback()
+        raise
+
+    db_conn.commit()
+
+    if db_conn.total_changes != changes_before:
+        invalidate_rss(chat_id_str)
+
+
+def get_links(chat_id: int | str, limit: int = 50) -> list[LinkData]:
+    """Get links for a group from database"""
+    chat_id_str = str(chat_id)
+
+    with read_connection() as conn:
+        if not conn:
+            return []
+        rows = conn.execute(SQL_SELECT_LINKS, (chat_id_str, limit)).fetchall()
+
+    links_list = []
+    for row in rows:
+        link = LinkData(
+            url=row[0],
+            title=row[1],
+            description=row[2],
+            image=row[3],
+            message_id=row[4],
+            date=row[5],
+        )
+        links_list.append(link)
+
+    return links_list
+
+
+def decode_html(content: bytes, charset: str | None) -> str | None:
+    """Decode an HTML document with the charset from its Content-Type, if any"""
+    if not charset:
+        return None
+
+    try:
+        return content.decode(charset, errors="replace")
+    except LookupError:
+        # Unknown charset name, let the parser sniff it instead
+        return None
+
+
+def parse_og_tags(content: bytes, charset: str | None = None) -> OGData:
+    """Extract Open Graph tags from the <head> of an HTML document"""
+    # The Content-Type charset wins, otherwise let lexbor detect it from the bytes
+    text = decode_html(content, charset)
+    parser = LexborHTMLParser(text) if text is not None else LexborHTMLParser(content, encoding=True)
+    head = parser.head
+    if head is None:
+        return OGData()
+
+    def meta_content(selector: str) -> str | None:
+        node = head.css_first(selector)
+        return node.attributes.get("content") if node else None
+
+    title_tag = head.css_first("title")
+    page_title = title_tag.text() if title_tag else None
+
+    return OGData(
+        # Fallback to title tag
+        title=meta_content('meta[property="og:title"]') or page_title or None,
+        # Fallback to meta description
+        description=meta_content('meta[property="og:description"]') or meta_content('meta[name="description"]'),
+        image=meta_content('meta[property="og:image"]'),
+    )
+
+
+def remember_og_tags(url: str, entry: tuple[OGData, float]) -> None:
+    """Insert into the in-memory OG cache, evicting the least recently used entries"""
+    og_cache[url] = entry
+    og_cache.move_to_end(url)
+    while len(og_cache) > OG_CACHE_SIZE:
+        og_cache.popitem(last=False)
+
+
+def load_og_tags(url: str) -> tuple[OGData, float] | None:
+    """Load cached OG tags and their fetch time from the database"""
+    with read_connection() as conn:
+        if not conn:
+            return None
+        row = conn.execute(SQL_SELECT_OG_CACHE, (url,)).fetchone()
+
+    if not row:
+        return None
+
+    return OGData(title=row[0], description=row[1], image=row[2]), row[3]
+
+
+def store_og_tags(url: str, og_data: OGData, fetched_at: float) -> None:
+    """Store OG tags in the database cache"""
+    if not db_conn:
+        return
+
+    db_conn.execute(SQL_UPSERT_OG_CACHE, (url, og_data.title, og_data.description, og_data.image, fetched_at))
+    db_conn.commit()
+
+
+async def read_html_head(response: httpx.Response) -> bytes:
+    """Read a streamed HTML body up to the end of <head>, abandoning the rest"""
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes(chunk_size=4096):
+        # Search only the new bytes, with some overlap in case the tag was split across chunks
+        start = max(0, len(buffer) - len(b"</head"))
+        buffer += chunk
+
+        end = bytes(buffer[start:]).lower().find(b"</head")
+        if end != -1:
+            return bytes(buffer[: start + end])
+        if len(buffer) >= OG_HEAD_MAX_BYTES:
+            break
+
+    return bytes(buffer[:OG_HEAD_MAX_BYTES])
+
+
+def acquire_host_semaphore(host: str) -> asyncio.Semaphore:
+    """Get the semaphore bounding fetches to a host, creating it on first use"""
+    semaphore = og_host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = og_host_semaphores[host] = asyncio.Semaphore(4)
+
+    og_host_users[host] = og_host_users.get(host, 0) + 1
+    return semaphore
+
+
+def release_host_semaphore(host: str) -> None:
+    """Drop a host's semaphore once no fetch holds or waits on it"""
+    og_host_users[host] -= 1
+    if not og_host_users[host]:
+        del og_host_users[host]
+        del og_host_semaphores[host]
+
+
+async def get_cached_og_tags(url: str) -> OGData | None:
+    """Get OG tags from the in-memory cache, falling back to the database"""
+    entry = og_cache.get(url)
+    if entry is None:
+        try:
+            entry = await asyncio.to_thread(load_og_tags, url)
+        except sqlite3.Error as e:
+            # The cache is only an optimization, fetch the page instead
+            print(f"Error loading cached OG tags for {url}: {e}")
+
+    if entry is None or time.time() - entry[1] > OG_CACHE_TTL:
+        og_cache.pop(url, None)
+        return None
+
+    remember_og_tags(url, entry)
+    return entry[0]
+
+
+async def fetch_og_tags(client: httpx.AsyncClient, url: str) -> OGData:
+    """Fetch Open Graph tags from a URL, using the cache when possible"""
+    cached = await get_cached_og_tags(url)
+    if cached is not None:
+        return cached
+
+    try:
+        host = urlparse(url).netloc
+        host_semaphore = acquire_host_semaphore(host)
+        try:
+            # Take the host slot first so waiting on a busy host doesn't hold a global slot
+            async with host_semaphore, og_fetch_semaphore:
+                async with client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    content = await read_html_head(response)
+                    charset = response.charset_encoding
+        finally:
+            release_host_semaphore(host)
+
+        # Parse off the event loop
+        og_data = await asyncio.to_thread(parse_og_tags, content, charset)
+
+    except Exception as e:
+        print(f"Error fetching OG tags for {url}: {e}")
+        return OGData()
+
+    fetched_at = time.time()
+    remember_og_tags(url, (og_data, fetched_at))
+    try:
+        await run_db_write(store_og_tags, url, og_data, fetched_at)
+    except sqlite3.Error as e:
+        print(f"Error caching OG tags for {url}: {e}")
+
+    return og_data
+
+
+def init_http_client() -> None:
+    """Create the shared HTTP client used for scraping"""
+    global http_client
+    http_client = httpx.AsyncClient(
+        # Fail fast when the pool is exhausted instead of stalling the handler
+        timeout=httpx.Timeout(10.0, connect=5.0, pool=5.0),
+        follow_redirects=True,
+        http2=True,
+        # Sized for bursts of links without starving the pool
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30.0),
+        headers={"User-Agent": "Mozilla/5.0 (compatible; TelegramRSSBot/1.0)"},
+    )
+
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client"""
+    if http_client:
+        await http_client.aclose()
+
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Extract and store links from messages"""
+    message = update.message or update.edited_message
+    if not message:
+        return
+
+    text = message.text or message.caption or ""
+    # Deduplicate while keeping the order links appear in
+    urls = list(dict.fromkeys(URL_PATTERN.findall(text)))
+    if not urls:
+        return
+
+    message_id = message.message_id
+    user_name = message.from_user.first_name if message.from_user else "Unknown"
+
+    if not http_client:
+        return
+
+    # Fetch OG tags for all links concurrently
+    og_results = await asyncio.gather(*[fetch_og_tags(http_client, url) for url in urls])
+
+    links_list = []
+    for url, og_data in zip(urls, og_results):
+        # Use OG data or fallback to URL
+        title = og_data.title if og_data.title else url
+        description = og_data.description if og_data.description else ""
+
+        # Add "Shared by" prefix to description
+        shared_by = f"Shared by {user_name}"
+        if description:
+            full_description = f"{shared_by} - {description}"
+        else:
+            full_description = shared_by
+
+        links_list.append(
+            LinkData(
+                url=url,
+                title=title,
+                description=full_description,
+                date=int(time.time()),
+                image=og_data.image,
+                message_id=message_id,
+            )
+        )
+
+    # Upsert this message's links, removing any dropped by an edit
+    await run_db_write(save_message_links, message.chat_id, message_id, links_list)
+
+    print(f"Found {len(urls)} link(s) in message from {user_name} in chat {message.chat_id}")
+
+
+def invalidate_rss(chat_id_str: str) -> None:
+    """Drop the cached feed for a group after its links changed"""
+    with rss_cache_lock:
+        rss_versions[chat_id_str] = next(rss_version_counter)
+        # Strictly increasing, so a change within the same second as the last one still beats If-Modified-Since
+        rss_modified[chat_id_str] = max(int(time.time()), rss_modified.get(chat_id_str, 0) + 1)
+        rss_cache.pop(chat_id_str, None)
+
+
+def render_rss_items(chat_id: int | str) -> str:
+    """Render the RSS <item> elements for a specific group"""
+    links_list = get_links(chat_id, limit=50)
+
+    parts = []
+    for link in links_list:
+        # Add enclosure for image if available
+        enclosure = f'<enclosure url={quoteattr(link.image)} type="image/jpeg" />' if link.image else ""
+
+        parts.append(
+            RSS_ITEM_TEMPLATE.format(
+                title=escape(link.title or ""),
+                url=escape(link.url),
+                description=escape(link.description or ""),
+                pub_date=time.strftime(RSS_DATE_FORMAT, time.gmtime(link.date)),
+                guid=escape(f"{link.url}_{link.date}"),
+                enclosure=enclosure,
+            )
+        )
+
+    return "".join(parts)
+
+
+def generate_rss(chat_id: int | str, items: str | None = None) -> str:
+    """Generate RSS feed XML for a specific group"""
+    if items is None:
+        items = render_rss_items(chat_id)
+
+    header = RSS_HEADER_TEMPLATE.format(
+        link=escape(f"{APP_URL}/rss/{chat_id}"),
+        build_date=time.strftime(RSS_DATE_FORMAT, time.gmtime()),
+    )
+
+    return header + items + RSS_FOOTER
+
+
+def get_rss_feed(chat_id: int | str) -> RssFeed:
+    """Get the rendered and gzipped RSS feed for a group, rendering it on a cache miss"""
+    chat_id_str = str(chat_id)
+    cached = rss_cache.get(chat_id_str)
+    if cached is not None:
+        return cached
+
+    # Remember the version so a feed rendered concurrently with a write isn't cached
+    with rss_cache_lock:
+        version = rss_versions.get(chat_id_str)
+        # Read alongside the version, a later invalidation must not date a render of older links
+        # Nothing changed since startup, so the first render is as good as it gets
+        last_modified = rss_modified.setdefault(chat_id_str, int(time.time()))
+
+    # Hash the items only, lastBuildDate changes on every render
+    items = render_rss_items(chat_id)
+    digest = hashlib.blake2b(items.encode(), digest_size=16).hexdigest()
+
+    xml = generate_rss(chat_id, items).encode()
+    feed = RssFeed(
+        xml=xml,
+        gzip=gzip.compress(xml, compresslevel=6),
+        etag=f'W/"{digest}"',
+        last_modified=last_modified,
+    )
+
+    with rss_cache_lock:
+        if rss_versions.get(chat_id_str) == version:
+            rss_cache[chat_id_str] = feed
+    return feed
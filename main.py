@@ -1,297 +1,79 @@
 import asyncio
-import os
-import re
-import sqlite3
-import uuid
-import xml.etree.ElementTree as ET
-from dataclasses import dataclass
-from datetime import datetime
-
-import httpx
+import hashlib
+import secrets
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
 import uvicorn
-from bs4 import BeautifulSoup
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response
 from telegram import Update
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
+from core import (
+    APP_URL,
+    DB_PATH,
+    HTTP_PORT,
+    SQL_SELECT_CHAT_BY_TOKEN,
+    TELEGRAM_TOKEN,
+    close_database,
+    close_http_client,
+    get_group_token,
+    get_rss_feed,
+    handle_message,
+    init_database,
+    init_http_client,
+    periodic_optimize,
+    read_connection,
+    run_db_write,
+)
+
+# Telegram sends this back in a header on every webhook call, derived so no extra config is needed
+WEBHOOK_SECRET = hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest() if TELEGRAM_TOKEN else ""
+
+# Format of the Last-Modified header
+HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+
+# Telegram bot application, fed by the webhook endpoint
+application: Application | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Set up the database, HTTP client and bot around the server's lifetime"""
+    # Initialize database
+    init_database()
 
-@dataclass
-class OGData:
-    """Open Graph metadata"""
-
-    title: str | None = None
-    description: str | None = None
-    image: str | None = None
-
-
-@dataclass
-class LinkData:
-    """Link data with metadata"""
-
-    url: str
-    title: str
-    description: str
-    date: datetime
-    image: str | None = None
-    message_id: int | None = None
-
-
-# Configuration
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-HTTP_PORT = int(os.getenv("HTTP_PORT", "8080"))
-APP_URL = os.getenv("APP_URL", f"http://localhost:{HTTP_PORT}")
-DB_PATH = os.getenv("DB_PATH", "links.local.db")
-
-# Store links in memory (use database for production)
-links = []
-
-# Database connection
-db_conn: sqlite3.Connection | None = None
-
-# URL regex pattern
-URL_PATTERN = re.compile(r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+")
-
-# FastAPI app
-app = FastAPI(title="Telegram RSS Feed")
-
-
-def init_database() -> None:
-    """Initialize SQLite database"""
-    global db_conn
-    # Use timeout for concurrent access
-    db_conn = sqlite3.connect(DB_PATH, timeout=10.0, check_same_thread=False)
-    db_conn.row_factory = sqlite3.Row
-    cursor = db_conn.cursor()
-
-    # Enable WAL mode for better concurrent access
-    cursor.execute("PRAGMA journal_mode=WAL")
-
-    # Set busy timeout for concurrent access (5 seconds)
-    cursor.execute("PRAGMA busy_timeout=5000")
-
-    # Balance between safety and performance
-    cursor.execute("PRAGMA synchronous=NORMAL")
-
-    # Increase cache size for better performance
-    cursor.execute("PRAGMA cache_size=-64000")
-
-    # Enable foreign keys
-    cursor.execute("PRAGMA foreign_keys=ON")
-
-    # Create groups table
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS groups (
-            chat_id TEXT PRIMARY KEY,
-            token TEXT UNIQUE NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """
-    )
-
-    # Create links table
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS links (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id TEXT NOT NULL,
-            url TEXT NOT NULL,
-            title TEXT,
-            description TEXT,
-            image TEXT,
-            message_id INTEGER,
-            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (chat_id) REFERENCES groups(chat_id)
-        )
-        """
-    )
-
-    db_conn.commit()
-
-
-def get_group_token(chat_id: int | str) -> str:
-    """Get or create token for a group"""
-    if not db_conn:
-        return ""
-
-    chat_id_str = str(chat_id)
-    cursor = db_conn.cursor()
-
-    # Check if group exists
-    cursor.execute("SELECT token FROM groups WHERE chat_id = ?", (chat_id_str,))
-    result = cursor.fetchone()
-
-    if result:
-        return result[0]
-
-    # Create new token for group
-    token = str(uuid.uuid4())
-    cursor.execute("INSERT INTO groups (chat_id, token) VALUES (?, ?)", (chat_id_str, token))
-    db_conn.commit()
-
-    return token
-
-
-def save_link(chat_id: int | str, link_data: LinkData) -> None:
-    """Save link to database"""
-    if not db_conn:
-        return
-
-    chat_id_str = str(chat_id)
-    cursor = db_conn.cursor()
-
-    cursor.execute(
-        """
-        INSERT INTO links (chat_id, url, title, description, image, message_id, date)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            chat_id_str,
-            link_data.url,
-            link_data.title,
-            link_data.description,
-            link_data.image,
-            link_data.message_id,
-            link_data.date,
-        ),
-    )
-    db_conn.commit()
-
-
-def get_links(chat_id: int | str, limit: int = 50) -> list[LinkData]:
-    """Get links for a group from database"""
-    if not db_conn:
-        return []
-
-    chat_id_str = str(chat_id)
-    cursor = db_conn.cursor()
-
-    cursor.execute(
-        """
-        SELECT url, title, description, image, message_id, date FROM links
-        WHERE chat_id = ? ORDER BY date DESC LIMIT ?
-        """,
-        (chat_id_str, limit),
-    )
-
-    links_list = []
-    for row in cursor.fetchall():
-        link = LinkData(
-            url=row[0],
-            title=row[1],
-            description=row[2],
-            image=row[3],
-            message_id=row[4],
-            date=datetime.fromisoformat(row[5]),
-        )
-        links_list.append(link)
-
-    return links_list
-
-
-def delete_group_links(chat_id: int | str, message_id: int) -> None:
-    """Delete links for a specific message"""
-    if not db_conn:
-        return
-
-    chat_id_str = str(chat_id)
-    cursor = db_conn.cursor()
+    # Initialize shared HTTP client
+    init_http_client()
 
-    cursor.execute("DELETE FROM links WHERE chat_id = ? AND message_id = ?", (chat_id_str, message_id))
-    db_conn.commit()
+    print("Configuration:")
+    print(f"  TELEGRAM_BOT_TOKEN: {'***' if TELEGRAM_TOKEN else 'Not Set'}")
+    print(f"  HTTP_PORT: {HTTP_PORT}")
+    print(f"  APP_URL: {APP_URL}")
+    print(f"  DB_PATH: {DB_PATH}")
 
+    # Keep the database lean while running
+    optimize_task = asyncio.create_task(periodic_optimize())
 
-async def fetch_og_tags(url: str) -> OGData:
-    """Fetch Open Graph tags from a URL"""
     try:
-        async with httpx.AsyncClient(timeout=10.0, follow_redirects=True) as client:
-            response = await client.get(
-                url, headers={"User-Agent": "Mozilla/5.0 (compatible; TelegramRSSBot/1.0)"}
-            )
-            response.raise_for_status()
-
-            soup = BeautifulSoup(response.text, "html.parser")
-
-            # Extract OG tags
-            og_data = OGData()
-
-            # Try og:title
-            og_title = soup.find("meta", property="og:title")
-            if og_title:
-                og_data.title = str(og_title.get("content"))
-
-            # Fallback to title tag
-            if not og_data.title:
-                title_tag = soup.find("title")
-                if title_tag:
-                    og_data.title = str(title_tag.string) if title_tag.string else None
-
-            # Try og:description
-            og_desc = soup.find("meta", property="og:description")
-            if og_desc:
-                og_data.description = str(og_desc.get("content"))
-
-            # Fallback to meta description
-            if not og_data.description:
-                meta_desc = soup.find("meta", attrs={"name": "description"})
-                if meta_desc:
-                    og_data.description = str(meta_desc.get("content"))
-
-            # Try og:image
-            og_image = soup.find("meta", property="og:image")
-            if og_image:
-                og_data.image = str(og_image.get("content"))
-
-            return og_data
-
-    except Exception as e:
-        print(f"Error fetching OG tags for {url}: {e}")
-        return OGData()
-
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Extract and store links from messages"""
-    message = update.message or update.edited_message
-    if not message:
-        return
-
-    text = message.text or message.caption or ""
-    urls = URL_PATTERN.findall(text)
-    if not urls:
-        return
+        # Telegram pushes updates to the FastAPI server, so the server is the only loop to run
+        await start_telegram_bot()
+        yield
+    finally:
+        print("\nShutting down...")
+        optimize_task.cancel()
+        await stop_telegram_bot()
+        await close_http_client()
+        close_database()
 
-    message_id = message.message_id
-    user_name = message.from_user.first_name if message.from_user else "Unknown"
-
-    # Remove existing links from this message (for edited messages)
-    delete_group_links(message.chat_id, message_id)
-
-    for url in urls:
-        # Fetch OG tags
-        og_data = await fetch_og_tags(url)
-
-        # Use OG data or fallback to URL
-        title = og_data.title if og_data.title else url
-        description = og_data.description if og_data.description else ""
-
-        # Add "Shared by" prefix to description
-        shared_by = f"Shared by {user_name}"
-        if description:
-            full_description = f"{shared_by} - {description}"
-        else:
-            full_description = shared_by
-
-        link_data = LinkData(
-            url=url,
-            title=title,
-            description=full_description,
-            date=datetime.now(),
-            image=og_data.image,
-            message_id=message_id,
-        )
-        save_link(message.chat_id, link_data)
 
-    print(f"Found {len(urls)} link(s) in message from {user_name} in chat {message.chat_id}")
+# FastAPI app
+app = FastAPI(title="Telegram RSS Feed", lifespan=lifespan)
 
 
 async def handle_rssfeed_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -303,7 +85,7 @@ async def handle_rssfeed_command(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     chat_id = update.message.chat_id
-    token = get_group_token(chat_id)
+    token = await run_db_write(get_group_token, chat_id)
 
     # Build RSS feed URL
     rss_url = f"{APP_URL}/rss?token={token}"
@@ -312,31 +94,45 @@ async def handle_rssfeed_command(update: Update, context: ContextTypes.DEFAULT_T
     await update.message.reply_text(message, parse_mode="Markdown")
 
 
-def generate_rss(chat_id: int | str) -> str:
-    """Generate RSS feed XML for a specific group"""
-    links_list = get_links(chat_id, limit=50)
+def accepts_gzip(request: Request) -> bool:
+    """Check whether the client accepts a gzip-encoded response"""
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+
+        # Honour an explicit "gzip;q=0" refusal
+        q = params.strip().removeprefix("q=")
+        try:
+            return not params or float(q) > 0
+        except ValueError:
+            return True
 
-    rss = ET.Element("rss", version="2.0")
-    channel = ET.SubElement(rss, "channel")
+    return False
 
-    ET.SubElement(channel, "title").text = "Telegram Group Links"
-    ET.SubElement(channel, "link").text = f"{APP_URL}/rss/{chat_id}"
-    ET.SubElement(channel, "description").text = "Links shared in Telegram group"
-    ET.SubElement(channel, "lastBuildDate").text = datetime.now().strftime("%a, %d %b %Y %H:%M:%S +0000")
 
-    for link in links_list:
-        item = ET.SubElement(channel, "item")
-        ET.SubElement(item, "title").text = link.title
-        ET.SubElement(item, "link").text = link.url
-        ET.SubElement(item, "description").text = link.description
-        ET.SubElement(item, "pubDate").text = link.date.strftime("%a, %d %b %Y %H:%M:%S +0000")
-        ET.SubElement(item, "guid").text = f"{link.url}_{link.date.timestamp()}"
+def is_not_modified(request: Request, etag: str, last_modified: int | None) -> bool:
+    """Check the request's conditional headers against the current feed state"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, as the ETag is weak anyway
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in tags
 
-        # Add enclosure for image if available
-        if link.image:
-            ET.SubElement(item, "enclosure", url=link.image, type="image/jpeg")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
 
-    return ET.tostring(rss, encoding="unicode", method="xml")
+        # HTTP dates are always GMT
+        if not since.tzinfo:
+            since = since.replace(tzinfo=timezone.utc)
+
+        return last_modified <= since.timestamp()
+
+    return False
 
 
 @app.get("/")
@@ -349,39 +145,48 @@ async def root():
     }
 
 
+# Plain (sync) handlers so FastAPI runs the blocking SQLite work in its threadpool
 @app.get("/rss")
-async def rss_feed(token: str = Query(..., description="Group authentication token")):
+def rss_feed(request: Request, token: str = Query(..., description="Group authentication token")):
     """RSS feed endpoint with token-based authentication"""
-    if not db_conn:
-        raise HTTPException(status_code=500, detail="Database not initialized")
-
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT chat_id FROM groups WHERE token = ?", (token,))
-    result = cursor.fetchone()
+    # Hand the connection back before rendering, which checks out its own
+    with read_connection() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="Database not initialized")
+        result = conn.execute(SQL_SELECT_CHAT_BY_TOKEN, (token,)).fetchone()
 
     if not result:
         raise HTTPException(status_code=401, detail="Unauthorized: Invalid token")
 
     chat_id = result[0]
-    rss_content = generate_rss(chat_id)
 
-    from fastapi.responses import Response
+    feed = get_rss_feed(chat_id)
+
+    # Let RSS readers skip unchanged feeds
+    headers = {"ETag": feed.etag, "Vary": "Accept-Encoding"}
+    if feed.last_modified:
+        headers["Last-Modified"] = time.strftime(HTTP_DATE_FORMAT, time.gmtime(feed.last_modified))
+
+    if is_not_modified(request, feed.etag, feed.last_modified):
+        return Response(status_code=304, headers=headers)
+
+    # Serve the precompressed body when possible
+    if accepts_gzip(request):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=feed.gzip, media_type="application/rss+xml", headers=headers)
 
-    return Response(content=rss_content, media_type="application/rss+xml")
+    return Response(content=feed.xml, media_type="application/rss+xml", headers=headers)
 
 
 @app.get("/health")
-async def health():
+def health():
     """Health check endpoint"""
-    if not db_conn:
-        return {"status": "error", "message": "Database not initialized"}
+    with read_connection() as conn:
+        if not conn:
+            return {"status": "error", "message": "Database not initialized"}
 
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM links")
-    link_count = cursor.fetchone()[0]
-
-    cursor.execute("SELECT COUNT(*) FROM groups")
-    group_count = cursor.fetchone()[0]
+        link_count = conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+        group_count = conn.execute("SELECT COUNT(*) FROM groups").fetchone()[0]
 
     return {
         "status": "ok",
@@ -390,6 +195,23 @@ async def health():
     }
 
 
+@app.post("/telegram")
+async def telegram_webhook(request: Request):
+    """Webhook endpoint receiving updates from Telegram"""
+    if not application:
+        raise HTTPException(status_code=503, detail="Bot not initialized")
+
+    secret = request.headers.get("x-telegram-bot-api-secret-token", "")
+    if not secrets.compare_digest(secret, WEBHOOK_SECRET):
+        raise HTTPException(status_code=401, detail="Unauthorized: Invalid secret token")
+
+    # Queue the update and answer right away, handlers run in the application's update loop
+    update = Update.de_json(await request.json(), application.bot)
+    await application.update_queue.put(update)
+
+    return {"status": "ok"}
+
+
 async def run_fastapi_server() -> None:
     """Run FastAPI server using uvicorn.Server"""
     print(f"FastAPI server starting on port {HTTP_PORT}")
@@ -399,14 +221,15 @@ async def run_fastapi_server() -> None:
     await server.serve()
 
 
-async def run_telegram_bot() -> None:
-    """Run the Telegram bot"""
+async def start_telegram_bot() -> None:
+    """Start the Telegram bot and point its webhook at this server"""
+    global application
     if not TELEGRAM_TOKEN:
         print("Error: TELEGRAM_BOT_TOKEN environment variable not set")
         return
 
-    # Create and configure bot
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Create and configure bot, updates are pushed to the webhook so no updater is needed
+    application = Application.builder().token(TELEGRAM_TOKEN).updater(None).build()
 
     # Add /rssfeed command handler
     application.add_handler(CommandHandler("rssfeed", handle_rssfeed_command))
@@ -414,42 +237,38 @@ async def run_telegram_bot() -> None:
     # Add message handler for new messages and edits
     application.add_handler(MessageHandler(filters.TEXT | filters.CAPTION, handle_message))
 
-    print("Bot started. Listening for messages in all chats")
-    print("Press Ctrl+C to stop")
-
     # Initialize and start bot
     await application.initialize()
     await application.start()
 
-    if not application.updater:
-        print("Error: Updater not initialized")
+    try:
+        await application.bot.set_webhook(
+            url=f"{APP_URL}/telegram",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    except TelegramError as e:
+        # Telegram only accepts public HTTPS URLs, keep serving the feeds anyway
+        print(f"Error setting webhook to {APP_URL}/telegram: {e}")
         return
 
-    await application.updater.start_polling()
+    print(f"Bot started. Receiving updates at {APP_URL}/telegram")
+    print("Press Ctrl+C to stop")
 
 
-async def main() -> None:
-    """Main function to run both servers concurrently"""
-    # Initialize database
-    init_database()
+async def stop_telegram_bot() -> None:
+    """Stop the Telegram bot"""
+    if not application:
+        return
 
-    print("Configuration:")
-    print(f"  TELEGRAM_BOT_TOKEN: {'***' if TELEGRAM_TOKEN else 'Not Set'}")
-    print(f"  HTTP_PORT: {HTTP_PORT}")
-    print(f"  APP_URL: {APP_URL}")
-    print(f"  DB_PATH: {DB_PATH}")
+    if application.running:
+        await application.stop()
+    await application.shutdown()
 
-    try:
-        # Run FastAPI and Telegram bot concurrently in the same event loop
-        await asyncio.gather(
-            run_fastapi_server(),
-            run_telegram_bot(),
-        )
-    except (KeyboardInterrupt, asyncio.CancelledError):
-        print("\nShutting down...")
-    finally:
-        if db_conn:
-            db_conn.close()
+
+async def main() -> None:
+    """Main function to run the HTTP server, the bot lives in the app's lifespan"""
+    await run_fastapi_server()
 
 
 if __name__ == "__main__":